@@ -1,10 +1,14 @@
 """
 User-interface for the pre-processing of ultrasound images. Contains all pre-processing functionality.
 
-Any work done to images is done to the images stored on the disk, and not the images stored in memory. The
-memory images are worked on, but permanent alterations are done to the disk images.
+Any work done to images is done to the images stored in memory, which are then written over the images stored on
+the disk. This keeps the memory images and the disk images in sync without reloading the recording.
 """
+import hashlib
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from pathlib import Path
 
@@ -13,12 +17,69 @@ import cv2
 import numpy as np
 from matplotlib import pyplot as plt
 from natsort import natsorted
-from skimage.metrics import structural_similarity
 
 # Graph dimensions for display.
 DISPLAY_DIMENSIONS = (800, 450)
 # Default clipping to have a roi for scan depth 150mm, width 220mm, transverse-transabdominal.
 CLIP_PIXELS = [228, 878, 476, 1428]
+# Minimum time between redraws when navigating (~60 fps), in ms.
+REDRAW_INTERVAL = 16
+# Number of frames checked between window refreshes during a duplicate scan.
+SCAN_REFRESH_INTERVAL = 32
+# Maximum number of differing perceptual hash bits for two frames to be compared as possible near duplicates.
+PHASH_THRESHOLD = 10
+# SSIM stabilising constants for 8-bit images, as used by x264's tiny_ssim.
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+
+def frame_hash(frame):
+    """
+    Hash the raw bytes of a frame. hashlib releases the GIL for large buffers, so frames can be hashed in parallel. The
+    buffer is hashed directly, so only non-contiguous (cropped) frames are copied.
+    """
+    return hashlib.blake2b(np.ascontiguousarray(frame), digest_size=16).digest()
+
+
+def perceptual_hash(frame):
+    """
+    Compute the 64 bit DCT perceptual hash of a grayscale image, packed into 8 bytes. This is similar to
+    cv2.img_hash.pHash, which is only available in opencv-contrib.
+    """
+    small = cv2.resize(frame, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = cv2.dct(small)[:8, :8]
+    return np.packbits(low_frequencies > np.median(low_frequencies))
+
+
+def frames_equal(img1, img2):
+    """
+    Check if two grayscale images are identical using a single absolute difference pass.
+    """
+    return img1.shape == img2.shape and cv2.countNonZero(cv2.absdiff(img1, img2)) == 0
+
+
+def fast_ssim(img1, img2):
+    """
+    Approximate the SSIM of two grayscale images using an 8x8 box window instead of a Gaussian window. This is the
+    block-sum approximation used by x264/ffmpeg and is considerably cheaper than skimage's structural_similarity.
+    """
+    img1 = img1.astype(np.float32)
+    img2 = img2.astype(np.float32)
+
+    mu1 = cv2.boxFilter(img1, cv2.CV_32F, (8, 8))
+    mu2 = cv2.boxFilter(img2, cv2.CV_32F, (8, 8))
+    mu1_sq = mu1 * mu1
+    mu2_sq = mu2 * mu2
+    mu1_mu2 = mu1 * mu2
+
+    sigma1_sq = cv2.boxFilter(img1 * img1, cv2.CV_32F, (8, 8)) - mu1_sq
+    sigma2_sq = cv2.boxFilter(img2 * img2, cv2.CV_32F, (8, 8)) - mu2_sq
+    sigma12 = cv2.boxFilter(img1 * img2, cv2.CV_32F, (8, 8)) - mu1_mu2
+
+    ssim_map = ((2 * mu1_mu2 + SSIM_C1) * (2 * sigma12 + SSIM_C2)) / (
+            (mu1_sq + mu2_sq + SSIM_C1) * (sigma1_sq + sigma2_sq + SSIM_C2))
+
+    return ssim_map.mean()
 
 
 class UltrasoundProcessing:
@@ -33,6 +94,10 @@ class UltrasoundProcessing:
         self.data = []
         self.index = 0
         self.duplicates = []
+        self.roi = (None, None, None, None)
+
+        self.redraw_pending = False
+        self.last_draw = 0
 
         self.enable_operations = False
         self.temp_files = []
@@ -49,6 +114,7 @@ class UltrasoundProcessing:
                    enable_events=True)],
             [Psg.Col(element_justification='c', expand_y=True, layout=[
                 [Psg.CB(k='-CB-REDUCED-ROI-', text='Reduced ROI', default=False, disabled=True)],
+                [Psg.T(text='Similarity:'), Psg.I(k='-INP-SIMILARITY-', size=7, default_text=1)],
                 [Psg.B(k='-BTN-DUPLICATE-CHECK-', size=18, button_text='Duplicate Check', expand_x=True)],
                 [Psg.B(k='-BTN-SHOW-DUPLICATES-', button_text='Show Duplicates', disabled=True, expand_x=True)],
                 [Psg.B(k='-BTN-REMOVE-DUPLICATES-', button_text='Remove Duplicates', disabled=True, expand_x=True)],
@@ -98,9 +164,10 @@ class UltrasoundProcessing:
         self.window['-INP-BOTTOM-'].bind('<Return>', '_Enter')
         self.window['-INP-LEFT-'].bind('<Return>', '_Enter')
         self.window['-INP-RIGHT-'].bind('<Return>', '_Enter')
+        self.update_roi()
 
         while True:
-            event, values = self.window.read()
+            event, values = self.window.read(timeout=REDRAW_INTERVAL)
 
             if event in (Psg.WIN_CLOSED, 'Exit'):
                 break
@@ -127,8 +194,10 @@ class UltrasoundProcessing:
                 self.show_plot()
 
             if event in ('-INP-TOP-' + '_Enter', '-INP-BOTTOM-' + '_Enter', '-INP-LEFT-' + '_Enter',
-                         '-INP-RIGHT-' + '_Enter') and self.enable_operations:
-                self.update_graph()
+                         '-INP-RIGHT-' + '_Enter'):
+                self.update_roi()
+                if self.enable_operations:
+                    self.update_graph()
 
             if event == '-BTN-DATA-' and self.enable_operations:
                 self.update_data_file()
@@ -139,6 +208,10 @@ class UltrasoundProcessing:
             if event == '-CB-ENABLE-ROI-' and self.enable_operations:
                 self.update_graph()
 
+            # Navigation only marks the graph for redrawing, so a burst of key presses is drawn once.
+            if self.redraw_pending and (time.perf_counter() - self.last_draw) * 1000 > REDRAW_INTERVAL:
+                self.update_graph()
+
         self.window.close()
 
     def update_data_file(self):
@@ -146,13 +219,13 @@ class UltrasoundProcessing:
         Update the data.txt file with correct values (dimensions and depths).
         """
         self.window['-TXT-INFO-'].update(
-            f"{self.window['-TXT-INFO-'].get()}\n"
+            f'\n'
             f'-----------------------------------------------------------------------------\n'
             f'                         Updating data.txt file\n'
             f'-----------------------------------------------------------------------------\n'
             f'    Dimensions: ({self.frames[0].shape[1]}, {self.frames[0].shape[0]}).\n'
             f"    Scan height: {self.window['-INP-HEIGHT-'].get()} mm, "
-            f"Scan width: {self.window['-INP-WIDTH-'].get()} mm.")
+            f"Scan width: {self.window['-INP-WIDTH-'].get()} mm.", append=True)
         self.window.refresh()
 
         data_temp = []
@@ -178,8 +251,8 @@ class UltrasoundProcessing:
 
         except FileNotFoundError as e:
             self.window['-TXT-INFO-'].update(
-                f"{self.window['-TXT-INFO-'].get()}\n"
-                f'  data.txt does not exist, creating blank data.')
+                f'\n'
+                f'  data.txt does not exist, creating blank data.', append=True)
 
             for name in self.names:
                 values = []
@@ -205,98 +278,110 @@ class UltrasoundProcessing:
 
         self.data = data_temp
         with open(str(self.recording_path) + '/data.txt', 'w') as file:
-            for row in self.data:
-                file.write(f"{','.join(row)}\n")
+            file.write(''.join(f"{','.join(row)}\n" for row in self.data))
 
         self.window['-TXT-INFO-'].update(
-            f"{self.window['-TXT-INFO-'].get()}\n"
-            f"    data.txt file updated.")
+            f'\n'
+            f"    data.txt file updated.", append=True)
 
     def clip_frames(self):
         """
         Cut out the region of interest on all frames.
         """
         self.enable_operations = False
-        if len(self.frames) > 0 and self.recording_path:
+        # Clip with the values currently entered, which are also the values drawn.
+        self.update_roi()
+        if len(self.frames) > 0 and self.recording_path and self.roi_in_bounds():
             self.window['-TXT-INFO-'].update(
-                f"{self.window['-TXT-INFO-'].get()}\n"
+                f'\n'
                 f'-----------------------------------------------------------------------------\n'
                 f'                         Clipping {len(self.frames)} frames...\n'
-                f'-----------------------------------------------------------------------------\n')
+                f'-----------------------------------------------------------------------------', append=True)
             self.window.refresh()
 
             try:
-                top = int(self.window['-INP-TOP-'].get())
-                bottom = int(self.window['-INP-BOTTOM-'].get())
-                left = int(self.window['-INP-LEFT-'].get())
-                right = int(self.window['-INP-RIGHT-'].get())
+                top, bottom, left, right = self.roi
 
                 self.window['-TXT-INFO-'].update(
-                    f"{self.window['-TXT-INFO-'].get()}\n"
-                    f"    Final shape will be: ({bottom - top}, {right - left})")
+                    f'\n'
+                    f"    Final shape will be: ({bottom - top}, {right - left})", append=True)
                 self.window.refresh()
 
-                # Clip the frames on disk.
-                for index, frame in enumerate(self.names):
-                    img = cv2.imread(self.recording_path + '/' + frame, cv2.IMREAD_UNCHANGED)
-
-                    clipped_frame = img[top:bottom, left:right]
-
-                    cv2.imwrite(self.recording_path + '/' + frame, clipped_frame)
+                # Clip the frames in memory, then write them to disk. Memory is only replaced once the disk is updated.
+                clipped = np.ascontiguousarray(self.frames[:, top:bottom, left:right])
+                if not self.write_frames(clipped):
+                    # The disk may be partially written, so reload the frames from disk.
+                    self.load_frames(self.recording_path)
+                    return
+                self.frames = clipped
 
                 self.window['-TXT-INFO-'].update(
-                    f"{self.window['-TXT-INFO-'].get()}\n"
-                    f'    Finished clipping {len(self.names)} frames to ({bottom - top}, {right - left}).')
+                    f'\n'
+                    f'    Finished clipping {len(self.names)} frames to ({bottom - top}, {right - left}).', append=True)
                 self.window.refresh()
 
-                self.load_frames(self.recording_path)
+                self.reset_duplicates()
+                self.update_details()
+                self.update_graph()
 
                 self.update_data_file()
             except (Exception,):
                 self.window['-TXT-INFO-'].update(
-                    f"{self.window['-TXT-INFO-'].get()}\nAn error occurred, ensure 'ints' are entered.")
+                    "\nAn error occurred, ensure 'ints' are entered.", append=True)
 
         self.enable_operations = True
 
-    def draw_roi_lines(self, frame):
+    def update_roi(self):
         """
-        Draw region of interest lines onto frame in memory.
+        Parse the region of interest inputs once and store them. Inputs that are not 'ints' are stored as None.
         """
-        top = self.window['-INP-TOP-'].get()
-        bottom = self.window['-INP-BOTTOM-'].get()
-        left = self.window['-INP-LEFT-'].get()
-        right = self.window['-INP-RIGHT-'].get()
+        roi = []
+        for key, label in (('-INP-TOP-', 'Top'), ('-INP-BOTTOM-', 'Bottom'), ('-INP-LEFT-', 'Left'),
+                           ('-INP-RIGHT-', 'Right')):
+            try:
+                roi.append(int(self.window[key].get()))
+            except ValueError:
+                roi.append(None)
+                self.window['-TXT-INFO-'].update(f"\n{label} is not an 'int'", append=True)
+        self.roi = tuple(roi)
 
-        try:
-            top = int(top)
-            cv2.line(frame, (0, top), (frame.shape[1], top), color=(0, 0, 255), thickness=1)
-        except (Exception,):
-            self.window['-TXT-INFO-'].update(f"{self.window['-TXT-INFO-'].get()}\nTop is not an 'int'")
+    def roi_in_bounds(self):
+        """
+        Check that the stored region of interest is made of 'ints' and selects a non-empty region of the frames. An
+        error is written to the info box if it does not.
+        """
+        if None not in self.roi:
+            top, bottom, left, right = self.roi
+            if 0 <= top < bottom <= self.frames.shape[1] and 0 <= left < right <= self.frames.shape[2]:
+                return True
 
-        try:
-            bottom = int(bottom)
-            cv2.line(frame, (0, bottom), (frame.shape[1], bottom), color=(0, 0, 255), thickness=1)
-        except (Exception,):
-            self.window['-TXT-INFO-'].update(f"{self.window['-TXT-INFO-'].get()}\nBottom is not an 'int'")
+        self.window['-TXT-INFO-'].update("\nAn error occurred, ensure 'ints' are entered.", append=True)
+        return False
 
-        try:
-            left = int(left)
-            cv2.line(frame, (left, 0), (left, frame.shape[0]), color=(0, 0, 255), thickness=1)
-        except (Exception,):
-            self.window['-TXT-INFO-'].update(f"{self.window['-TXT-INFO-'].get()}\nTop is not an 'int'")
+    def draw_roi_lines(self, frame, scale_x=1, scale_y=1):
+        """
+        Draw region of interest lines onto frame in memory, using the stored region of interest. If the frame has been
+        resized, scale_x and scale_y map the stored (original) pixel values onto the resized frame.
+        """
+        top, bottom, left, right = [None if value is None else int(value * scale)
+                                    for value, scale in zip(self.roi, (scale_y, scale_y, scale_x, scale_x))]
 
-        try:
-            right = int(right)
+        if top is not None:
+            cv2.line(frame, (0, top), (frame.shape[1], top), color=(0, 0, 255), thickness=1)
+        if bottom is not None:
+            cv2.line(frame, (0, bottom), (frame.shape[1], bottom), color=(0, 0, 255), thickness=1)
+        if left is not None:
+            cv2.line(frame, (left, 0), (left, frame.shape[0]), color=(0, 0, 255), thickness=1)
+        if right is not None:
             cv2.line(frame, (right, 0), (right, frame.shape[0]), color=(0, 0, 255), thickness=1)
-        except (Exception,):
-            self.window['-TXT-INFO-'].update(f"{self.window['-TXT-INFO-'].get()}\nTop is not an 'int'")
 
     def show_plot(self):
         """
         Show the current frame in a plot window. Used to find cut dimensions.
         """
+        self.update_roi()
         fig, ax = plt.subplots(figsize=(16, 9), dpi=80)
-        display_frame = self.frames[self.index].copy()
+        display_frame = cv2.cvtColor(self.frames[self.index], cv2.COLOR_GRAY2RGB)
         self.draw_roi_lines(display_frame)
         ax.imshow(display_frame)
         plt.show()
@@ -310,24 +395,55 @@ class UltrasoundProcessing:
             self.window['-TXT-ROTATED-'].update(f'Flipping {len(self.names)} frames\n')
             self.window.refresh()
 
-            for index, name in enumerate(self.names):
-                img = cv2.imread(self.recording_path + '/' + name, cv2.IMREAD_UNCHANGED)
-
-                flipped_frame = cv2.flip(img, 0)
-
-                cv2.imwrite(self.recording_path + '/' + name, flipped_frame)
+            # Flip the frames in memory, then write them to disk. Memory is only replaced once the disk is updated.
+            flipped = np.ascontiguousarray(self.frames[:, ::-1])
+            if not self.write_frames(flipped):
+                # The disk may be partially written, so reload the frames from disk.
+                self.window['-TXT-ROTATED-'].update('Flip failed.')
+                self.load_frames(self.recording_path)
+                return
+            self.frames = flipped
 
             self.window['-TXT-ROTATED-'].update(f'Flipped {len(self.names)} frames.')
             self.window.refresh()
 
-            self.load_frames(self.recording_path)
+            self.reset_duplicates()
+            self.update_graph()
         else:
             self.window['-TXT-INFO-'].update(
-                f"{self.window['-TXT-INFO-'].get()}\n"
-                f'    No frames to flip.')
+                f'\n'
+                f'    No frames to flip.', append=True)
 
         self.enable_operations = True
 
+    def reset_duplicates(self):
+        """
+        Clear the duplicates of a previous scan, as they may no longer be valid.
+        """
+        self.duplicates = []
+        self.window['-BTN-REMOVE-DUPLICATES-'].update(disabled=True)
+        self.window['-BTN-SHOW-DUPLICATES-'].update(disabled=True)
+        self.window['-TXT-DUPLICATE-COUNT-'].update(f'Possible Duplicates: ___')
+
+    def write_frames(self, frames):
+        """
+        Write frames (one per name) to disk, overwriting the frames in the recording folder. Frames that could not be
+        written are listed in the info box, and False is returned.
+        """
+
+        def write_frame(index):
+            return cv2.imwrite(self.recording_path + '/' + self.names[index], frames[index])
+
+        # OpenCV releases the GIL while encoding and writing, so threads scale.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            written = list(executor.map(write_frame, range(len(self.names))))
+
+        failed = [name for name, success in zip(self.names, written) if not success]
+        for name in failed:
+            self.window['-TXT-INFO-'].update(f'\n    Failed to write: {name}', append=True)
+
+        return len(failed) == 0
+
     def remove_duplicates(self):
         """
         Remove duplicate frames.
@@ -336,40 +452,38 @@ class UltrasoundProcessing:
         self.window['-TXT-SCAN-STATUS-'].update('Removing Duplicates...')
         self.window['-BTN-REMOVE-DUPLICATES-'].update(disabled=True)
         self.window['-TXT-INFO-'].update(
-            f"{self.window['-TXT-INFO-'].get()}\n"
+            f'\n'
             f'-----------------------------------------------------------------------------\n'
             f'                           Deleting Duplicates\n'
-            f'-----------------------------------------------------------------------------\n')
+            f'-----------------------------------------------------------------------------', append=True)
         self.window.refresh()
 
         # Remove duplicate .png and IMU data.
         if len(self.duplicates) > 0:
+            # Index rows by frame name so each duplicate's row is found without scanning all rows.
+            rows = {row.split(',', 1)[0]: row for row in self.data}
             for duplicate in self.duplicates:
                 remove_path = Path(self.recording_path, duplicate[1])
 
-                for row in self.data:
-                    if row.split(',', 1)[0] == duplicate[1].split('.', 1)[0]:
-                        self.window['-TXT-INFO-'].update(f"{self.window['-TXT-INFO-'].get()}\n"
-                                                         f'    Deleting: {remove_path.name}')
-                        self.window.refresh()
+                if rows.pop(duplicate[1].split('.', 1)[0], None) is not None:
+                    self.window['-TXT-INFO-'].update(f'\n'
+                                                     f'    Deleting: {remove_path.name}', append=True)
+                    self.window.refresh()
 
-                        # Delete .png frame.
-                        os.remove(remove_path)
-                        # Delete corresponding row.
-                        self.data.remove(row)
-                        break
+                    # Delete .png frame.
+                    os.remove(remove_path)
+            # Delete corresponding rows.
+            self.data = [row for row in self.data if row.split(',', 1)[0] in rows]
             # Rename files for consistency.
-            self.names = [x for x in natsorted(os.listdir(self.recording_path)) if x.split('.')[-1] == 'png']
+            self.names = natsorted(
+                entry.name for entry in os.scandir(self.recording_path) if entry.name.endswith('.png'))
             i = 1
             for name in self.names:
                 new_name = f"{i}-{name.split('-', 1)[1]}"
                 os.rename(Path(self.recording_path, name), Path(self.recording_path, new_name))
                 i += 1
             with open(str(self.recording_path) + '/data.txt', 'w') as file:
-                i = 1
-                for row in self.data:
-                    file.write(f"{i}-{row.split('-', 1)[1]}")
-                    i += 1
+                file.write(''.join(f"{i}-{row.split('-', 1)[1]}" for i, row in enumerate(self.data, start=1)))
 
         self.window['-TXT-SCAN-STATUS-'].update('Duplicates Removed.')
         self.enable_operations = True
@@ -380,31 +494,46 @@ class UltrasoundProcessing:
         Show duplicates.
         """
         self.window['-TXT-INFO-'].update(
-            f"{self.window['-TXT-INFO-'].get()}\n"
+            f'\n'
             f'-----------------------------------------------------------------------------\n'
             f'                            Duplicate Frames\n'
-            f'-----------------------------------------------------------------------------\n')
+            f'-----------------------------------------------------------------------------', append=True)
         for line in self.duplicates:
-            self.window['-TXT-INFO-'].update(f"{self.window['-TXT-INFO-'].get()}\n"
-                                             f"    {line[0]}  ->  {line[1]}\n")
+            self.window['-TXT-INFO-'].update(f'\n'
+                                             f"    {line[0]}  ->  {line[1]}", append=True)
 
     def check_for_duplicates(self, window=2):
         """
-        Compares each frame with the next 'window' frames. If reduced ROI is selected, only the ROI is used in the comparison of images. This should increase
-        comparison speed substantially as a lost of the image is not of interest.
+        Compares each frame with the previous 'window' frames. If similarity is 1, frames are hashed once and a frame is a
+        duplicate if its hash matches that of a frame within the window. If similarity is less than 1, a frame is a
+        (near) duplicate if its fast SSIM score with a frame within the window is at least similarity. If reduced ROI is
+        selected, only the ROI is used in the comparison of images.
         """
         self.enable_operations = False
 
-        top = int(self.window['-INP-TOP-'].get())
-        bottom = int(self.window['-INP-BOTTOM-'].get())
-        left = int(self.window['-INP-LEFT-'].get())
-        right = int(self.window['-INP-RIGHT-'].get())
+        reduced_roi = self.window['-CB-REDUCED-ROI-'].get()
+        self.update_roi()
+        # Checked before either hashing pass: an empty crop would make every frame an exact duplicate of the previous
+        # one, and cannot be resized for the perceptual hash used for near duplicates.
+        if reduced_roi and not self.roi_in_bounds():
+            self.enable_operations = True
+            return
+        top, bottom, left, right = self.roi
+
+        try:
+            similarity = float(self.window['-INP-SIMILARITY-'].get())
+        except ValueError:
+            similarity = None
+        if similarity is None or not 0 < similarity <= 1:
+            self.window['-TXT-INFO-'].update("\nAn error occurred, ensure similarity is in (0, 1].", append=True)
+            self.enable_operations = True
+            return
 
         self.window['-TXT-INFO-'].update(
-            f"{self.window['-TXT-INFO-'].get()}\n"
+            f'\n'
             f'-----------------------------------------------------------------------------\n'
             f'                         Starting Duplicate Scan\n'
-            f'-----------------------------------------------------------------------------\n')
+            f'-----------------------------------------------------------------------------', append=True)
         self.window['-TXT-DUPLICATE-COUNT-'].update(f'Possible Duplicates: ___')
 
         with open(self.recording_path + '/data.txt', 'r') as file:
@@ -412,37 +541,70 @@ class UltrasoundProcessing:
 
         total_files = len([x for x in os.listdir(self.recording_path)])
 
-        self.window['-TXT-INFO-'].update(f"{self.window['-TXT-INFO-'].get()}\n"
+        self.window['-TXT-INFO-'].update(f'\n'
                                          f'    Total files in directory: {total_files}.\n'
-                                         f'    Total .png frames in directory: {len(self.frames)}.\n')
+                                         f'    Total .png frames in directory: {len(self.frames)}.', append=True)
 
         self.duplicates = []  # Reset duplicates.
 
-        for i in range(0, len(self.frames) - 1):
-            img1 = cv2.cvtColor(self.frames[i], cv2.COLOR_BGR2GRAY)  # First image
-            if self.window['-CB-REDUCED-ROI-'].get():
-                img1 = img1[top:bottom, left:right]
-            for j in range(i + 1, i + window + 1):
-                if j < len(self.names):
-                    img2 = cv2.cvtColor(self.frames[j], cv2.COLOR_BGR2GRAY)  # Second image
-                    if self.window['-CB-REDUCED-ROI-'].get():
-                        img2 = img2[top:bottom, left:right]
-
-                    self.window['-TXT-SCAN-STATUS-'].update(f"Comparing {self.names[i].split('-', 1)[0]} "
-                                                            f"to {self.names[j].split('-', 1)[0]}")
-
-                    score = structural_similarity(img1, img2)  # Compare images
-                    if score == 1:  # 100% match.
-                        self.duplicates.append([self.names[i], self.names[j]])
-
-                        self.window['-TXT-DUPLICATE-COUNT-'].update(
-                            f'Possible Duplicates: {len(np.unique(np.array(self.duplicates)[:, 0]))}')
-                        # Once a duplicate is found, we can move on to the next set of images.
-                        break
+        # Crop every frame at once (a view, no copy), before any comparisons are made.
+        frames_gray = self.frames
+        if reduced_roi:
+            frames_gray = self.frames[:, top:bottom, left:right]
 
+        try:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                if similarity == 1:
+                    # Only 100% matches are of interest, so a hash of the raw bytes replaces a pairwise comparison.
+                    hashes = list(executor.map(frame_hash, frames_gray))
+                else:
+                    # Perceptual hashes filter out clearly different frames before the more expensive fast SSIM.
+                    phashes = np.array(list(executor.map(perceptual_hash, frames_gray)))
+        except cv2.error:
+            self.window['-TXT-INFO-'].update('\nAn error occurred, frames could not be hashed.', append=True)
+            self.window['-TXT-SCAN-STATUS-'].update('Scan Failed')
+            self.enable_operations = True
+            return
+
+        # Ring buffer of the hashes of the last 'window' frames, and the most recent frame index of each of them.
+        recent = deque(maxlen=window)
+        recent_indices = {}
+        # Frames that have a duplicate, for the duplicate count.
+        duplicate_firsts = set()
+        for i in range(0, len(self.frames)):
+            img = frames_gray[i]
+
+            previous = None
+            if similarity < 1:
+                # Near duplicates are found by comparing with each frame in the window, nearest first.
+                for j in range(i - 1, max(i - window, 0) - 1, -1):
+                    if np.unpackbits(np.bitwise_xor(phashes[i], phashes[j])).sum() > PHASH_THRESHOLD:
+                        continue
+                    if frames_equal(frames_gray[j], img) or fast_ssim(frames_gray[j], img) >= similarity:
+                        previous = j
+                        break
+            else:
+                key = hashes[i]
+                if key in recent_indices and frames_equal(frames_gray[recent_indices[key]], img):
+                    previous = recent_indices[key]
+                # The oldest hash drops out of the window, unless it reappeared within the window.
+                if len(recent) == window and recent_indices[recent[0]] == i - window:
+                    del recent_indices[recent[0]]
+                recent.append(key)
+                recent_indices[key] = i
+
+            if previous is not None:
+                self.duplicates.append([self.names[previous], self.names[i]])
+                duplicate_firsts.add(self.names[previous])
+
+            # Refreshing the window is more expensive than checking a frame, so only refresh periodically.
+            if i % SCAN_REFRESH_INTERVAL == 0:
+                self.window['-TXT-SCAN-STATUS-'].update(f"Checking {self.names[i].split('-', 1)[0]}")
+                self.window['-TXT-DUPLICATE-COUNT-'].update(f'Possible Duplicates: {len(duplicate_firsts)}')
                 self.window.refresh()
 
         if len(self.duplicates) > 0:
+            self.window['-TXT-DUPLICATE-COUNT-'].update(f'Possible Duplicates: {len(duplicate_firsts)}')
             self.window['-BTN-REMOVE-DUPLICATES-'].update(disabled=False)
             self.window['-BTN-SHOW-DUPLICATES-'].update(disabled=False)
         else:
@@ -452,8 +614,8 @@ class UltrasoundProcessing:
 
         self.window['-TXT-SCAN-STATUS-'].update(f'Scan Complete ({len(self.frames)}/{len(self.frames)})')
 
-        self.window['-TXT-INFO-'].update(f"{self.window['-TXT-INFO-'].get()}\n"
-                                         f"    Total duplicates detected: {len(self.duplicates)}.\n")
+        self.window['-TXT-INFO-'].update(f'\n'
+                                         f"    Total duplicates detected: {len(self.duplicates)}.", append=True)
 
         self.enable_operations = True
 
@@ -462,24 +624,62 @@ class UltrasoundProcessing:
         Load all frames in path folder into memory.
         """
         self.window['-TXT-INFO-'].update(
-            f"{self.window['-TXT-INFO-'].get()}\n"
+            f'\n'
             f'-----------------------------------------------------------------------------\n'
             f'                         Loading Frames\n'
-            f'-----------------------------------------------------------------------------\n')
+            f'-----------------------------------------------------------------------------', append=True)
         self.window.refresh()
 
+        self.enable_operations = False
         self.recording_path = path
-        self.names = [x for x in natsorted(os.listdir(self.recording_path)) if x.split('.')[-1] == 'png']
-        self.frames = []
+        self.names = natsorted(entry.name for entry in os.scandir(self.recording_path) if entry.name.endswith('.png'))
         self.data = []
         self.index = 0
-        self.duplicates = []
+        self.reset_duplicates()
+
+        # Frames are kept as grayscale in one contiguous (N, H, W) array, colour is only added for display. All frames
+        # must have the shape of the first frame.
+        first_frame = cv2.imread(path + '/' + self.names[0], cv2.IMREAD_UNCHANGED)
+        self.frames = np.empty((len(self.names),) + first_frame.shape, first_frame.dtype)
+        self.frames[0] = first_frame
+
+        def load_frame(index):
+            frame = cv2.imread(path + '/' + self.names[index], cv2.IMREAD_UNCHANGED)
+            if frame is None or frame.shape != first_frame.shape:
+                return False
+            self.frames[index] = frame
+            return True
+
+        # Decoding is done in parallel, each thread writes directly into its row of the array.
+        with ThreadPoolExecutor(max_workers=min(16, os.cpu_count() * 2)) as executor:
+            loaded = list(executor.map(load_frame, range(1, len(self.names))))
+
+        failed = [name for name, success in zip(self.names[1:], loaded) if not success]
+        if len(failed) > 0:
+            for name in failed:
+                self.window['-TXT-INFO-'].update(f'\n    Could not load (shape must be {first_frame.shape}): {name}',
+                                                 append=True)
+            self.window['-TXT-INFO-'].update(
+                f'\n'
+                f'                         Frames Not Loaded\n'
+                f'-----------------------------------------------------------------------------', append=True)
+            return
+
+        self.update_details()
+        self.window['-CB-REDUCED-ROI-'].update(disabled=False)
+
+        self.window['-TXT-INFO-'].update(
+            f'\n'
+            f'                         Frames Loaded\n'
+            f'-----------------------------------------------------------------------------', append=True)
 
-        for name in self.names:
-            frame = cv2.imread(path + '/' + name, cv2.IMREAD_UNCHANGED)
-            cf = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
-            self.frames.append(cf)
+        self.enable_operations = True
+        self.update_graph()
 
+    def update_details(self):
+        """
+        Update the recording details (frame count, duration, fps, and shape).
+        """
         try:
             duration = int(self.names[-1].split('.', 1)[0].split('-', 1)[1]) - int(
                 self.names[0].split('.', 1)[0].split('-', 1)[1])
@@ -490,18 +690,7 @@ class UltrasoundProcessing:
             f"Total Frames: {len(self.frames)}\t\t"
             f"Duration: {str(timedelta(milliseconds=duration)).split('.', 1)[0]}s\t\t"
             f"FPS: {int(len(self.frames) * 1000 / duration)}\t\t"
-            f"Shape: {cv2.imread(self.recording_path + '/' + self.names[0], cv2.IMREAD_UNCHANGED).shape}")
-        self.window['-BTN-REMOVE-DUPLICATES-'].update(disabled=True)
-        self.window['-BTN-SHOW-DUPLICATES-'].update(disabled=True)
-        self.window['-CB-REDUCED-ROI-'].update(disabled=False)
-
-        self.window['-TXT-INFO-'].update(
-            f"{self.window['-TXT-INFO-'].get()}\n"
-            f'                         Frames Loaded\n'
-            f'-----------------------------------------------------------------------------\n')
-
-        self.enable_operations = True
-        self.update_graph()
+            f"Shape: {self.frames[0].shape}")
 
     def navigate(self, command: str):
         """
@@ -517,7 +706,7 @@ class UltrasoundProcessing:
         elif self.index > len(self.frames) - 1:
             self.index = self.index - len(self.frames)
 
-        self.update_graph()
+        self.redraw_pending = True
 
     def update_graph(self):
         """
@@ -525,18 +714,24 @@ class UltrasoundProcessing:
         """
         self.window['-GRAPH-FRAME-'].erase()  # Prevents a memory leak
 
-        display_frame = self.frames[self.index].copy()
+        # Resize first so colour conversion and line drawing are done on the smaller display frame.
+        frame = self.frames[self.index]
+        display_frame = cv2.resize(frame, DISPLAY_DIMENSIONS, interpolation=cv2.INTER_AREA)
+        display_frame = cv2.cvtColor(display_frame, cv2.COLOR_GRAY2BGR)
 
         if self.window['-CB-ENABLE-ROI-'].get():
-            self.draw_roi_lines(display_frame)
-
-        display_frame = cv2.resize(display_frame, DISPLAY_DIMENSIONS, interpolation=cv2.INTER_AREA)
-        self.window['-GRAPH-FRAME-'].draw_image(data=cv2.imencode(".png", display_frame)[1].tobytes(),
+            self.draw_roi_lines(display_frame, scale_x=DISPLAY_DIMENSIONS[0] / frame.shape[1],
+                                scale_y=DISPLAY_DIMENSIONS[1] / frame.shape[0])
+        # PPM is uncompressed (unlike PNG) and natively supported by Tk's PhotoImage (unlike BMP).
+        self.window['-GRAPH-FRAME-'].draw_image(data=cv2.imencode(".ppm", display_frame)[1].tobytes(),
                                                 location=(0, DISPLAY_DIMENSIONS[1]))
 
         self.window['-TXT-INDEX-'].update(f'{self.index + 1}/{len(self.frames)}')
         self.window.refresh()
 
+        self.redraw_pending = False
+        self.last_draw = time.perf_counter()
+
 
 if __name__ == '__main__':
     UltrasoundProcessing()